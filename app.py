@@ -5,38 +5,412 @@ No OpenAI. Runs locally with Hugging Face Transformers + Torch.
 Usage:
     pip install -r requirements.txt
     streamlit run app.py
+
+Optional CPU deployment through ONNX Runtime with INT8 weights (picked up
+automatically when codegen-onnx-int8/ exists next to this file):
+    optimum-cli export onnx --model Salesforce/codegen-350M-mono \
+        --task text-generation-with-past codegen-onnx/
+    optimum-cli onnxruntime quantize --avx512 --onnx_model codegen-onnx/ \
+        -o codegen-onnx-int8/
 """
 
+import functools
+import json
+import os
+import re
+
+# Persist compiled Inductor kernels on disk so process restarts reuse them
+os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+def physical_cpu_count():
+    # Hyperthread siblings share the GEMM units, so count physical cores only
+    try:
+        import psutil
+        count = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        count = os.cpu_count() or 1
+    # Both report the host's cores; in a container only the affinity set is usable
+    if hasattr(os, "sched_getaffinity"):
+        count = min(count, len(os.sched_getaffinity(0)))
+    return count
+
+# OpenMP/MKL read these once, so they have to be set before torch is imported
+CPU_THREADS = physical_cpu_count()
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(CPU_THREADS))
+
 import streamlit as st
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+)
 import torch
 
+from transformers.cache_utils import DynamicCache, StaticCache
+
+from generation import (
+    PROMPT_PREFIX,
+    PROMPT_SUFFIX,
+    BatchStreamer,
+    GenerationBatcher,
+    GenerationCache,
+    HtmlEndStop,
+    MaskedRepetitionPenalty,
+    RowTokenCap,
+    encode_user_text,
+)
+
 # Use the smallest CodeGen model that can run in free-tier / local CPU
 MODEL_NAME = "Salesforce/codegen-350M-mono"
 
+# Weight-only INT8 quantization: bitsandbytes on CUDA, optimum-quanto on CPU.
+# Quantized weights are saved next to the app so restarts skip re-quantizing.
+QUANTIZE_INT8 = True
+QUANTIZED_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "codegen-350M-mono-int8"
+)
+
+# Exported + INT8-quantized ONNX model, used for CPU inference when present
+ONNX_MODEL_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "codegen-onnx-int8"
+)
+
+# TorchInductor + CUDA Graphs for the decode loop; needs torch >= 2.1
+COMPILE_MODEL = True
+
+# Longest prompt (template + description) and generation the app accepts; the
+# static KV cache is sized for their sum
+MAX_PROMPT_TOKENS = 512
+MAX_NEW_TOKENS = 800
+MAX_CONTEXT_TOKENS = MAX_PROMPT_TOKENS + MAX_NEW_TOKENS
+
+# Requests arriving within this window share one batched generate() call
+BATCH_WINDOW_S = 0.02
+MAX_BATCH_SIZE = 8
+
+# Finished generations kept for repeat clicks; decoding is greedy and batch
+# padding is masked out of both attention and the repetition penalty, so the
+# same (request, max_new_tokens) yields the same HTML whatever it is batched with
+GENERATION_CACHE_SIZE = 128
+
+
 @st.cache_resource
-def load_model():
-    # Load tokenizer + model on CPU
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
+def configure_cpu_threads():
+    # Once per process: interop threads can't be changed after parallel work starts
+    torch.set_num_threads(CPU_THREADS)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    torch.backends.mkldnn.enabled = True
+
+configure_cpu_threads()
+
+def select_device_dtype():
+    # Prefer half-precision weights wherever the hardware runs them natively
+    if torch.cuda.is_available():
+        if torch.cuda.is_bf16_supported():
+            return "cuda", torch.bfloat16
+        return "cuda", torch.float16
+    # bf16 on CPU only pays off with AMX tiles; otherwise stay in fp32
+    amx_supported = getattr(torch.cpu, "_is_amx_tile_supported", None)
+    if amx_supported is not None and amx_supported():
+        return "cpu", torch.bfloat16
+    return "cpu", torch.float32
+
+DEVICE, DTYPE = select_device_dtype()
+
+def torch_at_least(major, minor):
+    version = torch.__version__.split("+")[0].split(".")
+    return (int(version[0]), int(version[1])) >= (major, minor)
+
+def load_bnb_int8_model(save_dir):
+    # bitsandbytes stores its quantization config, so a saved copy reloads as-is
+    from transformers import BitsAndBytesConfig
+
+    # Check for the weights file, not the directory, so a half-written save is redone
+    if os.path.isfile(os.path.join(save_dir, "model.safetensors")):
+        # Non-quantized modules (embeddings, LayerNorm, lm_head) keep the selected dtype
+        return AutoModelForCausalLM.from_pretrained(
+            save_dir,
+            torch_dtype=DTYPE,
+            device_map="auto",
+        )
     model = AutoModelForCausalLM.from_pretrained(
         MODEL_NAME,
-        trust_remote_code=True,
-        torch_dtype=torch.float32
-    ).to("cpu")
+        torch_dtype=DTYPE,
+        quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+        device_map="auto",
+    )
+    model.save_pretrained(save_dir)
+    return model
+
+def load_quanto_int8_model(save_dir):
+    # quanto needs its quantization map alongside the weights to requantize
+    from optimum.quanto import freeze, qint8, quantization_map, quantize, requantize
+    from safetensors.torch import load_file, save_file
+    from transformers import AutoConfig
+
+    weights_path = os.path.join(save_dir, "model.safetensors")
+    qmap_path = os.path.join(save_dir, "quantization_map.json")
+    if os.path.isfile(weights_path) and os.path.isfile(qmap_path):
+        config = AutoConfig.from_pretrained(save_dir)
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(config, torch_dtype=DTYPE)
+        with open(qmap_path) as f:
+            qmap = json.load(f)
+        requantize(model, load_file(weights_path), qmap, device=torch.device(DEVICE))
+        model.tie_weights()
+        return model.eval()
+
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        torch_dtype=DTYPE
+    ).to(DEVICE)
+    quantize(model, weights=qint8)
+    freeze(model)
+    os.makedirs(save_dir, exist_ok=True)
+    model.config.save_pretrained(save_dir)
+    # safetensors refuses non-contiguous views
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+    save_file(state_dict, weights_path)
+    with open(qmap_path, "w") as f:
+        json.dump(quantization_map(model), f)
+    return model
+
+def load_int8_model():
+    # Returns None when the quantization backend for this device isn't installed
+    save_dir = f"{QUANTIZED_DIR}-{DEVICE}"
+    try:
+        if DEVICE == "cuda":
+            import bitsandbytes  # noqa: F401
+            return load_bnb_int8_model(save_dir)
+        import optimum.quanto  # noqa: F401
+        return load_quanto_int8_model(save_dir)
+    except ImportError:
+        return None
+
+def optimize_for_intel_cpu(model):
+    # intel-extension-for-pytorch swaps in oneDNN kernels (AMX-BF16 GEMMs where available)
+    try:
+        import intel_extension_for_pytorch as ipex
+    except ImportError:
+        return model
+    return ipex.optimize(model.eval(), dtype=DTYPE)
+
+def load_onnx_model():
+    # Returns None unless on CPU with an exported model and optimum[onnxruntime]
+    if DEVICE != "cpu" or not os.path.isdir(ONNX_MODEL_DIR):
+        return None
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError:
+        return None
+    return ORTModelForCausalLM.from_pretrained(
+        ONNX_MODEL_DIR, provider="CPUExecutionProvider"
+    )
+
+@st.cache_resource
+def load_model():
+    # Load tokenizer + model on the selected device / dtype
+    # CodeGen is built into transformers; insist on the Rust-backed tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+    if not tokenizer.is_fast:
+        raise RuntimeError("A fast tokenizer is required; install the `tokenizers` package.")
+    model = load_onnx_model()
+    if model is None and QUANTIZE_INT8:
+        model = load_int8_model()
+    if model is None:
+        model = AutoModelForCausalLM.from_pretrained(
+            MODEL_NAME,
+            torch_dtype=DTYPE
+        ).to(DEVICE)
+        if DEVICE == "cpu":
+            model = optimize_for_intel_cpu(model)
+
+    # ONNX Runtime models are already fused ahead of time and can't be compiled
+    if COMPILE_MODEL and torch_at_least(2, 1) and isinstance(model, torch.nn.Module):
+        # generate() calls self.forward, so compile that rather than wrapping the module.
+        # Compilation happens lazily, during the serving-path warmup in load_batcher().
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
     return tokenizer, model
 
 tokenizer, model = load_model()
 
-PROMPT_TEMPLATE = """You are a code generation model.
-Generate only valid HTML code in a single file.
-Do not include explanations or comments outside HTML.
-The code must begin with <!doctype html> or <html>.
-Keep CSS inline unless otherwise requested.
+# Transformers cache objects (prefix reuse, StaticCache) only work with the torch model
+REUSE_KV_CACHE = isinstance(model, torch.nn.Module)
 
-User request: {user_request}
+@st.cache_resource
+def load_prompt_prefix():
+    # Run the prefix prefill once and keep its K/V for every request
+    prefix_ids = tokenizer(PROMPT_PREFIX, return_tensors="pt").input_ids.to(model.device)
+    if not REUSE_KV_CACHE:
+        return prefix_ids, None
+    # A one-off call: run it on the eager forward so it neither compiles a graph
+    # of its own nor fails before load_batcher() can fall back to eager
+    forward = getattr(model.forward, "_torchdynamo_orig_callable", model.forward)
+    with torch.inference_mode():
+        outputs = forward(input_ids=prefix_ids, use_cache=True)
+    prefix_kv = outputs.past_key_values
+    if hasattr(prefix_kv, "to_legacy_cache"):
+        prefix_kv = prefix_kv.to_legacy_cache()
+    return prefix_ids, prefix_kv
 
-HTML_CODE:
-"""
+PREFIX_IDS, PREFIX_KV = load_prompt_prefix()
+
+@st.cache_resource
+def load_prompt_suffix():
+    return tokenizer(
+        PROMPT_SUFFIX, add_special_tokens=False, return_tensors="pt"
+    ).input_ids[0].to(model.device)
+
+SUFFIX_IDS = load_prompt_suffix()
+
+def encode_request(user_input):
+    # Only the user's text needs tokenizing; the template parts are pre-encoded
+    user_ids = encode_user_text(tokenizer, user_input).to(model.device)
+    return torch.cat([user_ids, SUFFIX_IDS])
+
+def make_static_cache():
+    # Fixed shapes and buffer addresses only pay off for CUDA graphs, i.e. a
+    # compiled forward on CUDA; everywhere else a DynamicCache sized to the
+    # actual batch is cheaper. One cache, reset between batches, sized for the
+    # longest request the batcher accepts.
+    compiled = "forward" in vars(model)
+    supported = getattr(model, "_supports_static_cache", False) or getattr(
+        model, "_can_compile_fullgraph", False
+    )
+    if DEVICE != "cuda" or not compiled or not REUSE_KV_CACHE or not supported:
+        return None
+    return StaticCache(
+        config=model.config,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_cache_len=MAX_CONTEXT_TOKENS,
+        device=model.device,
+        dtype=model.dtype,
+    )
+
+def make_prefilled_cache(batch_size, static_cache):
+    # Cache for one batch seeded with the prefix K/V; the shared copy is never mutated
+    if PREFIX_KV is None:
+        return None
+    prefix_kv = tuple(
+        (key.expand(batch_size, -1, -1, -1), value.expand(batch_size, -1, -1, -1))
+        for key, value in PREFIX_KV
+    )
+    if static_cache is None:
+        return DynamicCache.from_legacy_cache(prefix_kv)
+    static_cache.reset()
+    positions = torch.arange(PREFIX_IDS.shape[1], device=model.device)
+    for layer_idx, (key, value) in enumerate(prefix_kv):
+        static_cache.update(key, value, layer_idx, {"cache_position": positions})
+    return static_cache
+
+def run_batch(batch, static_cache=None):
+    # Pad between the shared prefix and each user's tokens so the cached
+    # prefix K/V lines up for every row; masked pads don't shift positions.
+    user_len = max(request.user_ids.shape[0] for request in batch)
+    max_new_tokens = max(request.max_new_tokens for request in batch)
+    input_rows, mask_rows = [], []
+    for request in batch:
+        pad = user_len - request.user_ids.shape[0]
+        input_rows.append(torch.cat([
+            PREFIX_IDS[0],
+            torch.full((pad,), tokenizer.eos_token_id, dtype=torch.long, device=model.device),
+            request.user_ids,
+        ]))
+        mask_rows.append(torch.cat([
+            torch.ones(PREFIX_IDS.shape[1], dtype=torch.long, device=model.device),
+            torch.zeros(pad, dtype=torch.long, device=model.device),
+            torch.ones(request.user_ids.shape[0], dtype=torch.long, device=model.device),
+        ]))
+    if static_cache is not None:
+        # The static cache has a fixed batch size; fill it with copies of row 0
+        filler = MAX_BATCH_SIZE - len(batch)
+        input_rows += [input_rows[0]] * filler
+        mask_rows += [mask_rows[0]] * filler
+    input_ids = torch.stack(input_rows)
+    attention_mask = torch.stack(mask_rows)
+    # Filler rows get a cap of 0 so generate() ends once every real row is done
+    caps = torch.zeros(input_ids.shape[0], dtype=torch.long, device=model.device)
+    caps[:len(batch)] = torch.tensor([request.max_new_tokens for request in batch])
+
+    streamer = BatchStreamer(tokenizer, batch)
+    with torch.inference_mode(), torch.autocast(
+        device_type=DEVICE, dtype=DTYPE, enabled=DTYPE != torch.float32
+    ):
+        # Built inside inference mode: the cache is written in place with
+        # the (inference-mode) prefix K/V tensors
+        past_key_values = make_prefilled_cache(input_ids.shape[0], static_cache)
+        model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.eos_token_id,
+            use_cache=True,
+            past_key_values=past_key_values,
+            streamer=streamer,
+            logits_processor=LogitsProcessorList([
+                MaskedRepetitionPenalty(1.05, attention_mask),
+            ]),
+            stopping_criteria=StoppingCriteriaList([
+                RowTokenCap(input_ids.shape[1], caps),
+                HtmlEndStop(tokenizer, input_ids.shape[1]),
+            ]),
+        )
+
+@st.cache_resource
+def load_batcher():
+    # One batcher (and worker thread) shared by every Streamlit session
+    compiled = "forward" in vars(model)
+    batcher = GenerationBatcher(
+        functools.partial(run_batch, static_cache=make_static_cache()),
+        prefix_len=PREFIX_IDS.shape[1],
+        max_context=MAX_CONTEXT_TOKENS,
+        window_s=BATCH_WINDOW_S,
+        max_batch_size=MAX_BATCH_SIZE,
+    )
+
+    def warmup():
+        # Push one request through the real serving path (prefix cache, static
+        # cache, streamer) so compilation and autotuning happen at load time
+        for _ in batcher.submit(encode_request("x"), 4):
+            pass
+
+    try:
+        warmup()
+    except Exception:
+        if not compiled:
+            raise
+        # Inductor or CUDA graphs can fail here (no C++ toolchain, quantized
+        # modules it can't trace); drop the compiled forward and its static
+        # cache and serve from the eager forward
+        del model.forward
+        batcher.run_batch = functools.partial(run_batch, static_cache=None)
+        warmup()
+    return batcher
+
+batcher = load_batcher()
+
+@st.cache_resource
+def load_generation_cache():
+    # Shared across sessions, like the model itself
+    return GenerationCache(GENERATION_CACHE_SIZE)
+
+generation_cache = load_generation_cache()
+
+# Start of the HTML document, found without building a lowercased copy
+HTML_START_RE = re.compile(r"<!doctype|<html", re.IGNORECASE)
+
+def extract_html(text):
+    # Extract just the HTML part
+    match = HTML_START_RE.search(text)
+    if match:
+        text = text[match.start():]
+    return text.strip()
 
 st.set_page_config(page_title="AI HTML Generator", page_icon="💻")
 st.title("💻 AI HTML Code Generator")
@@ -47,45 +421,39 @@ user_input = st.text_area(
     "Landing page for a bakery with hero section, 3 feature highlights, and a contact form."
 )
 
-max_new_tokens = st.slider("Max new tokens", 100, 800, 300, step=50)
+max_new_tokens = st.slider("Max new tokens", 100, MAX_NEW_TOKENS, 300, step=50)
 
 if st.button("Generate HTML"):
     if not user_input.strip():
         st.error("Please enter a description.")
     else:
-        with st.spinner("Generating HTML..."):
-            prompt = PROMPT_TEMPLATE.format(user_request=user_input.strip())
-            inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=max_new_tokens,
-                    temperature=0.2,
-                    top_p=0.95,
-                    repetition_penalty=1.05,
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id,
-                )
-
-            generated = tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-            # Extract just the HTML part
-            text = generated
-            lowered = text.lower()
-            start = lowered.find("<!doctype")
-            if start == -1:
-                start = lowered.find("<html")
-            if start != -1:
-                text = text[start:]
-            text = text.strip()
-
-            st.subheader("Generated HTML")
-            st.code(text, language="html")
-
-            st.download_button(
-                "Download HTML file",
-                text,
-                file_name="generated.html",
-                mime="text/html"
-            )
+        st.subheader("Generated HTML")
+        placeholder = st.empty()
+
+        cache_key = (user_input.strip(), max_new_tokens)
+        text = generation_cache.get(cache_key)
+        if text is None:
+            try:
+                request = batcher.submit(encode_request(user_input), max_new_tokens)
+            except ValueError as exc:
+                st.error(str(exc))
+                st.stop()
+
+            # Render tokens as they arrive instead of after the whole decode; the
+            # spinner also covers the wait while an earlier batch is still decoding
+            generated = ""
+            with st.spinner("Generating HTML..."):
+                for chunk in request:
+                    generated += chunk
+                    placeholder.code(generated, language="html")
+
+            text = extract_html(generated)
+            generation_cache.put(cache_key, text)
+        placeholder.code(text, language="html")
+
+        st.download_button(
+            "Download HTML file",
+            text,
+            file_name="generated.html",
+            mime="text/html"
+        )
@@ -0,0 +1,241 @@
+"""
+Model-independent pieces of the generation path used by app.py: the prompt
+template and the batching of concurrent requests into one generate() call.
+Nothing here imports Streamlit or loads the model.
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+
+PROMPT_TEMPLATE = """You are a code generation model.
+Generate only valid HTML code in a single file.
+Do not include explanations or comments outside HTML.
+The code must begin with <!doctype html> or <html>.
+Keep CSS inline unless otherwise requested.
+
+User request: {user_request}
+
+HTML_CODE:
+"""
+
+# The boilerplate before the user's text is identical for every request. Its
+# trailing space is left to the user part so BPE merges it with the first word,
+# exactly as when the whole prompt is tokenized in one go.
+PROMPT_PREFIX = PROMPT_TEMPLATE.split("{user_request}")[0].rstrip(" ")
+PROMPT_SUFFIX = PROMPT_TEMPLATE.split("{user_request}")[1]
+
+def encode_user_text(tokenizer, user_input):
+    # The suffix starts with whitespace, which BPE never merges into the user's
+    # last word, so prefix + user + suffix ids match a whole-prompt encoding
+    return tokenizer(
+        " " + user_input.strip(), add_special_tokens=False, return_tensors="pt"
+    ).input_ids[0]
+
+class GenerationRequest:
+    """One user's generation; iterate it to receive decoded text chunks."""
+
+    def __init__(self, user_ids, max_new_tokens):
+        self.user_ids = user_ids
+        self.max_new_tokens = max_new_tokens
+        self.chunks = queue.Queue()
+        self.error = None
+
+    def fail(self, error):
+        self.error = error
+        self.chunks.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+class RowTokenCap(StoppingCriteria):
+    """Stops each row at its own request's max_new_tokens."""
+
+    def __init__(self, prompt_len, caps):
+        self.prompt_len = prompt_len
+        self.caps = caps
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return input_ids.shape[1] - self.prompt_len >= self.caps
+
+class MaskedRepetitionPenalty(LogitsProcessor):
+    """repetition_penalty that ignores the pad positions inside batched prompts."""
+
+    def __init__(self, penalty, prompt_mask):
+        self.penalty = penalty
+        self.prompt_mask = prompt_mask.bool()
+
+    def __call__(self, input_ids, scores):
+        generated = input_ids.shape[1] - self.prompt_mask.shape[1]
+        mask = torch.cat([
+            self.prompt_mask,
+            torch.ones(input_ids.shape[0], generated, dtype=torch.bool, device=input_ids.device),
+        ], dim=1)
+        # Point pad positions at the row's last token, which is penalized anyway,
+        # so only tokens the row really contains get their logits changed
+        ids = torch.where(mask, input_ids, input_ids[:, -1:])
+        score = torch.gather(scores, 1, ids)
+        score = torch.where(score < 0, score * self.penalty, score / self.penalty)
+        return scores.scatter(1, ids, score)
+
+class HtmlEndStop(StoppingCriteria):
+    """Stops each row as soon as its generated text contains </html>."""
+
+    def __init__(self, tokenizer, prompt_len, tail_tokens=12):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.tail_tokens = tail_tokens
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # Only the last few generated tokens can complete the closing tag
+        start = max(self.prompt_len, input_ids.shape[1] - self.tail_tokens)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        return torch.tensor(
+            ["</html>" in tail.lower() for tail in tails],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+class BatchStreamer(BaseStreamer):
+    """Routes each row of a batched generate() to its request's chunk queue."""
+
+    def __init__(self, tokenizer, requests):
+        self.tokenizer = tokenizer
+        self.requests = requests
+        self.token_cache = [[] for _ in requests]
+        self.printed_len = [0] * len(requests)
+        self.generated = [0] * len(requests)
+        self.done = [False] * len(requests)
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        # The first call carries the prompt, which is never echoed back
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        # Rows past the real requests are filler for a fixed-size static cache
+        for row, token_id in enumerate(value.view(-1).tolist()[:len(self.requests)]):
+            if self.done[row]:
+                continue
+            if token_id == self.tokenizer.eos_token_id:
+                self._finish(row)
+                continue
+            self.token_cache[row].append(token_id)
+            self.generated[row] += 1
+            text = self.tokenizer.decode(self.token_cache[row], skip_special_tokens=True)
+            if text.endswith("\n"):
+                # Line finished: flush it and start decoding afresh
+                self.requests[row].chunks.put(text[self.printed_len[row]:])
+                self.token_cache[row] = []
+                self.printed_len[row] = 0
+            elif not text.endswith("\ufffd"):
+                # Hold back incomplete multi-byte characters
+                self.requests[row].chunks.put(text[self.printed_len[row]:])
+                self.printed_len[row] = len(text)
+            if self.generated[row] >= self.requests[row].max_new_tokens:
+                self._finish(row)
+
+    def end(self):
+        for row in range(len(self.requests)):
+            self._finish(row)
+
+    def _finish(self, row):
+        if self.done[row]:
+            return
+        text = self.tokenizer.decode(self.token_cache[row], skip_special_tokens=True)
+        if len(text) > self.printed_len[row]:
+            self.requests[row].chunks.put(text[self.printed_len[row]:])
+        self.requests[row].chunks.put(None)
+        self.done[row] = True
+
+class GenerationBatcher:
+    """Collects requests arriving within window_s and decodes them together.
+
+    run_batch(batch) performs the decode and must finish every request in the
+    batch; it is a plain attribute so the caller can swap it out.
+    """
+
+    def __init__(self, run_batch, prefix_len, max_context, window_s, max_batch_size):
+        self.run_batch = run_batch
+        self.prefix_len = prefix_len
+        self.max_context = max_context
+        self.window_s = window_s
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, user_ids, max_new_tokens):
+        # Reject here: an over-length prompt would fail generate() for the whole batch
+        request = GenerationRequest(user_ids, max_new_tokens)
+        if not self._fits([request]):
+            raise ValueError(
+                f"The request needs more than {self.max_context} tokens of context; "
+                "shorten the description or lower max new tokens."
+            )
+        self.queue.put(request)
+        return request
+
+    def _fits(self, batch):
+        # Rows are padded to the longest prompt and decode up to the largest cap
+        user_len = max(request.user_ids.shape[0] for request in batch)
+        max_new_tokens = max(request.max_new_tokens for request in batch)
+        return self.prefix_len + user_len + max_new_tokens <= self.max_context
+
+    def _run(self):
+        pending = None
+        while True:
+            batch = [pending if pending is not None else self.queue.get()]
+            pending = None
+            deadline = time.monotonic() + self.window_s
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if not self._fits(batch + [request]):
+                    # Fits alone (checked in submit), so it leads the next batch
+                    pending = request
+                    break
+                batch.append(request)
+            try:
+                self.run_batch(batch)
+            except Exception as exc:
+                for request in batch:
+                    request.fail(exc)
+
+class GenerationCache:
+    """Thread-safe LRU of finished HTML keyed by (user_input, max_new_tokens)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
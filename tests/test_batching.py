@@ -0,0 +1,127 @@
+import pytest
+import torch
+from transformers import RepetitionPenaltyLogitsProcessor
+
+from generation import (
+    BatchStreamer,
+    GenerationBatcher,
+    GenerationRequest,
+    MaskedRepetitionPenalty,
+    RowTokenCap,
+)
+
+
+class StubTokenizer:
+    """Token 0 is EOS, 1 is a newline, and n >= 2 decodes to a letter."""
+
+    eos_token_id = 0
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join("\n" if i == 1 else chr(ord("a") + i - 2) for i in ids if i != 0)
+
+
+def request(user_len=1, max_new_tokens=10):
+    return GenerationRequest(torch.zeros(user_len, dtype=torch.long), max_new_tokens)
+
+
+def step(streamer, *tokens):
+    streamer.put(torch.tensor(tokens))
+
+
+def test_streamer_routes_each_row_to_its_request():
+    first, second = request(), request()
+    # Three rows: the last one is static-cache filler and must be ignored
+    streamer = BatchStreamer(StubTokenizer(), [first, second])
+    streamer.put(torch.tensor([[5, 5], [6, 6], [7, 7]]))  # prompt, never echoed
+    step(streamer, 2, 3, 4)
+    step(streamer, 1, 3, 4)
+    step(streamer, 0, 2, 4)  # first row hits EOS
+    step(streamer, 0, 1, 4)
+    streamer.end()
+
+    assert "".join(first) == "a\n"
+    assert "".join(second) == "bba\n"
+
+
+def test_streamer_stops_row_at_its_own_cap():
+    short, long = request(max_new_tokens=2), request(max_new_tokens=4)
+    streamer = BatchStreamer(StubTokenizer(), [short, long])
+    streamer.put(torch.tensor([[5], [5]]))
+    for _ in range(4):
+        step(streamer, 2, 3)
+    streamer.end()
+
+    assert "".join(short) == "aa"
+    assert "".join(long) == "bbbb"
+
+
+def test_row_token_cap_stops_each_row_independently():
+    caps = torch.tensor([2, 0, 5])
+    criteria = RowTokenCap(prompt_len=3, caps=caps)
+    input_ids = torch.zeros(3, 5, dtype=torch.long)  # two tokens generated
+
+    assert criteria(input_ids, None).tolist() == [True, True, False]
+
+
+def test_masked_repetition_penalty_skips_pad_positions():
+    scores = torch.full((2, 10), 2.0)
+    prompt_mask = torch.tensor([[1, 0, 1], [1, 1, 1]])
+    input_ids = torch.tensor([[3, 7, 4, 5], [3, 7, 4, 5]])
+
+    out = MaskedRepetitionPenalty(1.05, prompt_mask)(input_ids, scores.clone())
+
+    # Token 7 only appears in row 0 as a pad, so it stays untouched there
+    assert out[0, 7] == 2.0
+    for token in (3, 4, 5):
+        assert out[0, token] == pytest.approx(2.0 / 1.05)
+    # Without pads it matches the stock repetition penalty
+    expected = RepetitionPenaltyLogitsProcessor(1.05)(input_ids[1:], scores[1:].clone())
+    assert torch.equal(out[1:], expected)
+
+
+def finishing_batcher(max_context, window_s=0.5):
+    batches = []
+
+    def run_batch(batch):
+        batches.append([r.user_ids.shape[0] for r in batch])
+        for r in batch:
+            r.chunks.put(None)
+
+    batcher = GenerationBatcher(
+        run_batch, prefix_len=0, max_context=max_context, window_s=window_s, max_batch_size=8
+    )
+    return batcher, batches
+
+
+def test_batcher_defers_request_that_does_not_fit_current_batch():
+    batcher, batches = finishing_batcher(max_context=10)
+    # Each fits alone, but 6 prompt tokens + 7 new tokens overflow together
+    first = batcher.submit(torch.zeros(2, dtype=torch.long), 7)
+    second = batcher.submit(torch.zeros(6, dtype=torch.long), 3)
+    third = batcher.submit(torch.zeros(1, dtype=torch.long), 1)
+    for r in (first, second, third):
+        list(r)
+
+    assert batches == [[2], [6, 1]]
+
+
+def test_batcher_rejects_request_that_never_fits():
+    batcher, batches = finishing_batcher(max_context=10)
+
+    with pytest.raises(ValueError):
+        batcher.submit(torch.zeros(8, dtype=torch.long), 3)
+    assert batches == []
+
+
+def test_batch_failure_is_raised_in_every_request():
+    def run_batch(batch):
+        raise RuntimeError("boom")
+
+    batcher = GenerationBatcher(
+        run_batch, prefix_len=0, max_context=100, window_s=0.2, max_batch_size=8
+    )
+    requests = [batcher.submit(torch.zeros(1, dtype=torch.long), 1) for _ in range(2)]
+
+    for r in requests:
+        with pytest.raises(RuntimeError, match="boom"):
+            list(r)
@@ -0,0 +1,38 @@
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from generation import PROMPT_PREFIX, PROMPT_SUFFIX, PROMPT_TEMPLATE, encode_user_text
+
+MODEL_NAME = "Salesforce/codegen-350M-mono"
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    try:
+        return AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+    except OSError as exc:
+        pytest.skip(f"{MODEL_NAME} tokenizer unavailable: {exc}")
+
+
+@pytest.mark.parametrize("user_input", [
+    "Landing page for a bakery with hero section, 3 feature highlights, and a contact form.",
+    "3 column pricing table",
+    "(dark mode) portfolio site",
+    "...and a footer",
+    "Signup form with validation!",
+    "Is a navbar possible?",
+    "  surrounded by whitespace  ",
+    "table with  two  spaces",
+    "résumé page in Français",
+])
+def test_split_encoding_matches_whole_prompt(tokenizer, user_input):
+    # app.py concatenates separately encoded pieces; they must equal one encode
+    prefix_ids = tokenizer(PROMPT_PREFIX, return_tensors="pt").input_ids[0]
+    suffix_ids = tokenizer(PROMPT_SUFFIX, add_special_tokens=False, return_tensors="pt").input_ids[0]
+    split_ids = torch.cat([prefix_ids, encode_user_text(tokenizer, user_input), suffix_ids])
+
+    prompt = PROMPT_TEMPLATE.format(user_request=user_input.strip())
+    whole_ids = tokenizer(prompt, return_tensors="pt").input_ids[0]
+
+    assert split_ids.tolist() == whole_ids.tolist()